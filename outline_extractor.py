@@ -4,123 +4,216 @@ import re
 import json
 import time
 import argparse
-import io
+import hashlib
+import mmap
+import queue
+import threading
 import fitz  # PyMuPDF
-from collections import Counter
+import numpy as np
+from functools import partial
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import cpu_count
-from PIL import Image
 
 # ─── Backwards‑compatible Resampling Filter ───────────────────────────────────
+def resample_filter(Image):
+    """LANCZOS filter for both old and new (>= 9.1) Pillow APIs."""
+    try:
+        return Image.Resampling.LANCZOS
+    except AttributeError:
+        return Image.LANCZOS
+
+# ─── Heading levels, indexed by size_levels() codes ─────────────────────────
+LEVELS = (None, "H1", "H2", "H3")
+
+# size_levels() decision table: row = bold, column = size above body text
+# bucketed by _SIZE_STEPS (<1, 1-2, 2-4, >=4 pt)
+_SIZE_STEPS = np.array([1.0, 2.0, 4.0])
+_SIZE_LEVEL_TABLE = np.array([[0, 0, 2, 1],
+                              [0, 3, 2, 1]], dtype=np.int8)
+
+# Heading text patterns, compiled once for the per-span checks
+_CHAPTER_RE = re.compile(r'^(?:chapter|section|part)\s+\d+', re.IGNORECASE)
+_NUMBERED_RE = re.compile(r'^\d+\.?\s+[A-Z]')
+_SUBSECTION_RE = re.compile(r'^\d+\.\d+\.?\s+')
+_NON_WORD_RE = re.compile(r'\W+')
+
+# Span prefixes that mark captions/page labels rather than headings; matched
+# as one case-insensitive alternation instead of lowercasing every span
+BOILERPLATE_PREFIXES = ('page ', 'figure ', 'table ')
+_BOILERPLATE_RE = re.compile(
+    '(?:' + '|'.join(map(re.escape, BOILERPLATE_PREFIXES)) + ')', re.IGNORECASE)
+
+# Text-only "dict" extraction: without TEXT_PRESERVE_IMAGES PyMuPDF skips
+# building image blocks (and copying their binary data) for every page
+SPAN_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# ─── JSON output (orjson when installed, same formatting as json.dump) ────────
 try:
-    RESAMPLE = Image.Resampling.LANCZOS
-except AttributeError:
-    RESAMPLE = Image.LANCZOS
-
-def get_body_font_size(doc, max_pages=3):
-    """Detect the most common font size (body text)."""
-    sizes = []
-    for page_num in range(min(len(doc), max_pages)):
-        page = doc[page_num]
-        for block in page.get_text("dict")["blocks"]:
-            if block["type"] != 0:
-                continue
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    if len(text.split()) >= 3:
-                        sizes.append(round(span["size"], 1))
+    import orjson
+except ImportError:
+    orjson = None
+
+def write_json(path, obj, indent=True):
+    """Write obj as UTF-8 JSON, 2-space indented unless indent is False."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0))
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2 if indent else None)
+
+# ─── Input reading ────────────────────────────────────────────────────────────
+# PDFs below this size are read into memory in one go and opened from there
+STREAM_MAX_BYTES = 32 * 1024 * 1024
+
+# ─── Outline cache (output_dir/.cache, keyed by PDF content hash) ─────────────
+CACHE_DIR = ".cache"
+CACHE_VERSION = 3  # bump when extraction heuristics change
+
+def page_spans(page):
+    """Flatten a page's text into (size, text, flags, bbox) span tuples."""
+    spans = []
+    for block in page.get_text("dict", flags=SPAN_FLAGS)["blocks"]:
+        if block["type"] != 0:
+            continue
+        for line in block["lines"]:
+            for span in line["spans"]:
+                text = span["text"].strip()
+                if text:
+                    spans.append((span["size"], text, span.get("flags", 0), span["bbox"]))
+    return spans
+
+def get_page_spans(doc, span_cache, page_num):
+    """Return the spans of a page, extracting them only on first access."""
+    spans = span_cache.get(page_num)
+    if spans is None:
+        spans = span_cache[page_num] = page_spans(doc[page_num])
+    return spans
+
+def body_size_histogram(doc, span_cache, page_nums):
+    """Counts of body-like spans (3+ words) per 0.1pt font size bin, or None."""
+    sizes = [round(size, 1)
+             for page_num in page_nums
+             for size, text, _, _ in get_page_spans(doc, span_cache, page_num)
+             if len(text.split()) >= 3]
     if not sizes:
+        return None
+    return np.bincount(np.rint(np.asarray(sizes) * 10).astype(np.intp))
+
+def get_body_font_size(doc, span_cache, max_pages=3):
+    """Detect the most common font size (body text) from the first pages.
+
+    When the two most common sizes are within 10% of each other, the middle
+    and last pages are sampled too before picking one.
+    """
+    pages = list(range(min(len(doc), max_pages)))
+    counts = body_size_histogram(doc, span_cache, pages)
+    if counts is not None and np.count_nonzero(counts) >= 2:
+        runner_up, top = np.sort(counts)[-2:]
+        extra = [p for p in (len(doc) // 2, len(doc) - 1) if p not in pages]
+        if runner_up >= 0.9 * top and extra:
+            counts = body_size_histogram(doc, span_cache, pages + sorted(set(extra)))
+    if counts is None:
         return 12.0
-    return Counter(sizes).most_common(1)[0][0]
+    # Ties resolve to the smaller size
+    return float(counts.argmax()) / 10.0
 
-def is_heading(text, font_size, is_bold, body_size):
-    """Determine if text is likely a heading."""
-    txt = text.strip()
-    if len(txt) < 3 or len(txt) > 100:
+def size_levels(sizes, bolds, body_size):
+    """Classify spans by size and boldness: 1=H1, 2=H2, 3=H3, 0=undecided."""
+    steps = np.searchsorted(_SIZE_STEPS, sizes - body_size, side="right")
+    return _SIZE_LEVEL_TABLE[bolds.astype(np.intp), steps]
+
+def is_heading(text, size_level=0):
+    """Determine if stripped span text is likely a heading, given its size_levels() code."""
+    if len(text) < 3 or len(text) > 100:
         return None
-    if txt.lower().startswith(('page ', 'figure ', 'table ')):
+    if _BOILERPLATE_RE.match(text):
         return None
-    size_diff = font_size - body_size
-    if size_diff >= 4:
-        return "H1"
-    if size_diff >= 2:
-        return "H2"
-    if is_bold and size_diff >= 1:
-        return "H3" if size_diff < 2 else "H2"
-    if re.match(r'^(chapter|section|part)\s+\d+', txt.lower()):
+    if size_level:
+        return LEVELS[size_level]
+    if _CHAPTER_RE.match(text):
         return "H1"
-    if re.match(r'^\d+\.?\s+[A-Z]', txt):
+    if _NUMBERED_RE.match(text):
         return "H2"
-    if re.match(r'^\d+\.\d+\.?\s+', txt):
+    if _SUBSECTION_RE.match(text):
         return "H3"
     return None
 
-def extract_headings(doc):
+def extract_headings(doc, span_cache=None):
     """Extract headings from PDF via simple heuristics."""
-    body_size = get_body_font_size(doc)
+    if span_cache is None:
+        span_cache = {}
+    body_size = get_body_font_size(doc, span_cache)
     headings = []
-    seen = set()
-    for pno, page in enumerate(doc, start=1):
+    for page_num in range(len(doc)):
         if len(headings) >= 30:
             break
-        for block in page.get_text("dict")["blocks"]:
-            if block["type"] != 0:
-                continue
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    text = span["text"].strip()
-                    if not text:
-                        continue
-                    font_size = round(span["size"], 1)
-                    is_bold = bool(span.get("flags", 0) & 16)
-                    level = is_heading(text, font_size, is_bold, body_size)
-                    if level:
-                        key = (level, re.sub(r'\W+', '', text.lower()), pno)
-                        if key not in seen:
-                            headings.append({"level": level, "text": text, "page": pno})
-                            seen.add(key)
+        spans = get_page_spans(doc, span_cache, page_num)
+        if not spans:
+            continue
+        pno = page_num + 1
+        # Duplicates are only dropped within a page, so the set starts empty
+        seen = set()
+        # Size/bold tests run over the whole page at once; only the text
+        # checks are done per span.
+        n = len(spans)
+        sizes = np.fromiter((round(sp[0], 1) for sp in spans), np.float64, n)
+        if sizes.max() - body_size < 1:
+            # Nothing on this page is large enough for a size-based level
+            levels = [0] * n
+        else:
+            bolds = np.fromiter((sp[2] & 16 for sp in spans), bool, n)
+            levels = size_levels(sizes, bolds, body_size).tolist()
+        for (_, text, _, _), size_level in zip(spans, levels):
+            level = is_heading(text, size_level)
+            if level:
+                key = (level, _NON_WORD_RE.sub('', text.lower()))
+                if key not in seen:
+                    headings.append({"level": level, "text": text, "page": pno})
+                    seen.add(key)
     return headings
 
-def get_title(doc):
+def get_title(doc, span_cache=None):
     """Extract document title."""
     meta = doc.metadata.get("title", "").strip()
     if meta and len(meta.split()) >= 2:
         return meta
     if doc.page_count == 0:
         return ""
+    if span_cache is None:
+        span_cache = {}
     candidates = []
-    for block in doc[0].get_text("dict")["blocks"]:
-        if block["type"] != 0:
-            continue
-        for line in block["lines"]:
-            for span in line["spans"]:
-                t = span["text"].strip()
-                sz = span["size"]
-                if 2 <= len(t.split()) <= 12 and sz >= 14:
-                    candidates.append((sz, t, span["bbox"][1]))
+    for sz, t, _, bbox in get_page_spans(doc, span_cache, 0):
+        if 2 <= len(t.split()) <= 12 and sz >= 14:
+            candidates.append((sz, t, bbox[1]))
     if not candidates:
         return ""
     candidates.sort(key=lambda x: (-x[0], x[2]))
     return candidates[0][1]
 
-def generate_thumbnail(doc, output_path, size=(300, 400), quality=85):
-    """Generate a first-page thumbnail at output_path."""
+def render_thumbnail(doc, size=(300, 400)):
+    """Render the first page of doc to raw RGB pixels for thumbnailing."""
     try:
-        if doc.page_count == 0:
-            print(f"Warning: no pages to thumbnail: {output_path}")
-            return False
         page = doc[0]
-        pix = page.get_pixmap(matrix=fitz.Matrix(1.5, 1.5), alpha=False)
-        img = Image.open(io.BytesIO(pix.tobytes("png")))
-        img.thumbnail(size, RESAMPLE)
-        # Ensure RGB
-        if img.mode in ("RGBA", "LA"):
-            bg = Image.new("RGB", img.size, (255,255,255))
-            bg.paste(img, mask=img.split()[-1])
-            img = bg
-        elif img.mode != "RGB":
-            img = img.convert("RGB")
+        # Render at twice the thumbnail scale (never above 1.5x) so the
+        # LANCZOS downscale still has detail to work with, without
+        # rasterizing far more pixels than the thumbnail keeps
+        fit = min(size[0] / page.rect.width, size[1] / page.rect.height)
+        zoom = min(1.5, 2 * fit)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+        return (pix.width, pix.height), pix.samples
+    except Exception as e:
+        print(f"✗ Thumbnail failed: {e}")
+        return None
+
+def save_thumbnail(pixels, output_path, size=(300, 400), quality=85):
+    """Downscale a rendered page and save it as a JPEG thumbnail at output_path."""
+    try:
+        # Pillow is only needed with --thumbnails, so it is imported lazily
+        from PIL import Image
+        # Wrap the raw samples directly instead of a PNG encode/decode round trip
+        img = Image.frombytes("RGB", *pixels)
+        img.thumbnail(size, resample_filter(Image))
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         img.save(output_path, "JPEG", quality=quality, optimize=True)
         return True
@@ -128,65 +221,185 @@ def generate_thumbnail(doc, output_path, size=(300, 400), quality=85):
         print(f"✗ Thumbnail failed: {e}")
         return False
 
-def process_pdf(pdf_path, output_dir, generate_thumbs=False, thumb_size=(300,400)):
-    """Process a single PDF: title, headings, optional thumbnail."""
+def fingerprint_pdf(pdf_path, data=None):
+    """Content hash identifying a PDF in the outline cache.
+
+    Hashes data when the file was read into memory, else memory-maps the file.
+    """
+    if data is None:
+        with open(pdf_path, "rb") as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm, digest_size=16).hexdigest()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def cache_path(cache_dir, digest):
+    """Location of the cached outline for a PDF fingerprint."""
+    return os.path.join(cache_dir, f"{digest}.v{CACHE_VERSION}.json")
+
+def load_cached_outline(cache_dir, digest):
+    """Return the cached {title, outline} for digest, or None on a miss."""
+    try:
+        with open(cache_path(cache_dir, digest), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def store_cached_outline(cache_dir, digest, entry):
+    """Atomically write a {title, outline} cache entry."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, digest)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    write_json(tmp, entry, indent=False)
+    os.replace(tmp, path)
+
+def read_pdf(pdf_path):
+    """I/O stage: read a PDF's bytes from disk, or None for large files.
+
+    One sequential read beats PyMuPDF's many small reads on slow volumes;
+    files of STREAM_MAX_BYTES or more are left for fitz to open by path.
+    """
+    if os.path.getsize(pdf_path) >= STREAM_MAX_BYTES:
+        return pdf_path, None
+    with open(pdf_path, "rb") as fp:
+        return pdf_path, fp.read()
+
+def parse_pdf(pdf_path, data, generate_thumbs=False, thumb_size=(300,400), cache_dir=None):
+    """Parse stage: title, headings and optional thumbnail render of a PDF.
+
+    With a cache_dir, outlines of previously seen PDFs are reused and the
+    document is only opened when a thumbnail has to be rendered.
+    """
     fname = os.path.basename(pdf_path)
-    base = fname[:-4]
-    with fitz.open(pdf_path) as doc:
-        title = get_title(doc)
-        headings = extract_headings(doc)
-        thumb_file = None
+    cached = digest = None
+    if cache_dir:
+        digest = fingerprint_pdf(pdf_path, data)
+        cached = load_cached_outline(cache_dir, digest)
+    if cached and not generate_thumbs:
+        return {"file": fname, "title": cached["title"],
+                "outline": cached["outline"], "thumb_pixels": None}
+    thumb_pixels = None
+    doc = fitz.open(pdf_path) if data is None else fitz.open(stream=data, filetype="pdf")
+    with doc:
+        if cached:
+            title, headings = cached["title"], cached["outline"]
+        else:
+            # One text extraction per page, shared by title, body size and headings
+            span_cache = {}
+            title = get_title(doc, span_cache)
+            headings = extract_headings(doc, span_cache)
         if generate_thumbs:
-            thumb_dir = os.path.join(output_dir, "thumbnails")
-            thumb_file = os.path.join(thumb_dir, f"{base}.jpg")
-            if not generate_thumbnail(doc, thumb_file, thumb_size):
-                thumb_file = None
-    result = {"file": fname, "headings": len(headings)}
+            if doc.page_count == 0:
+                print(f"Warning: no pages to thumbnail: {pdf_path}")
+            else:
+                thumb_pixels = render_thumbnail(doc, thumb_size)
+    if digest and not cached:
+        store_cached_outline(cache_dir, digest, {"title": title, "outline": headings})
+    return {"file": fname, "title": title, "outline": headings, "thumb_pixels": thumb_pixels}
+
+def write_outputs(parsed, output_dir, thumb_size=(300,400)):
+    """Write stage: encode the thumbnail and write the outline JSON."""
+    fname = parsed["file"]
+    base = fname[:-4]
+    thumb_file = None
+    if parsed["thumb_pixels"] is not None:
+        thumb_file = os.path.join(output_dir, "thumbnails", f"{base}.jpg")
+        if not save_thumbnail(parsed["thumb_pixels"], thumb_file, thumb_size):
+            thumb_file = None
+    result = {"file": fname, "headings": len(parsed["outline"])}
     # write JSON
-    out = {"source_file": fname, "title": title, "outline": headings}
+    out = {"source_file": fname, "title": parsed["title"], "outline": parsed["outline"]}
     if thumb_file:
         out["thumbnail"] = f"thumbnails/{os.path.basename(thumb_file)}"
     json_path = os.path.join(output_dir, f"{base}.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    write_json(json_path, out)
     return result
 
+def process_pdf(pdf_path, output_dir, generate_thumbs=False, thumb_size=(300,400),
+                use_cache=True):
+    """Process a single PDF: title, headings, optional thumbnail."""
+    cache_dir = os.path.join(output_dir, CACHE_DIR) if use_cache else None
+    parsed = parse_pdf(*read_pdf(pdf_path), generate_thumbs=generate_thumbs,
+                       thumb_size=thumb_size, cache_dir=cache_dir)
+    return write_outputs(parsed, output_dir, thumb_size)
+
+def run_pipeline(pdfs, output_dir, generate_thumbs=False, thumb_size=(300,400),
+                 use_cache=True):
+    """Process PDFs in one process, overlapping the read, parse and write stages.
+
+    Reader and parser threads feed bounded queues; the write stage runs in
+    the caller and yields results in input order, re-raising stage errors.
+    """
+    cache_dir = os.path.join(output_dir, CACHE_DIR) if use_cache else None
+    parse_q = queue.Queue(maxsize=4)
+    write_q = queue.Queue(maxsize=4)
+
+    def reader():
+        try:
+            for pdf in pdfs:
+                parse_q.put(read_pdf(pdf))
+        except Exception as e:
+            parse_q.put(e)
+        parse_q.put(None)
+
+    def parser():
+        try:
+            while (item := parse_q.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                write_q.put(parse_pdf(*item, generate_thumbs=generate_thumbs,
+                                      thumb_size=thumb_size, cache_dir=cache_dir))
+        except Exception as e:
+            write_q.put(e)
+        write_q.put(None)
+
+    for stage in (reader, parser):
+        threading.Thread(target=stage, daemon=True).start()
+    while (parsed := write_q.get()) is not None:
+        if isinstance(parsed, Exception):
+            raise parsed
+        yield write_outputs(parsed, output_dir, thumb_size)
+
 def main():
     p = argparse.ArgumentParser("PDF Outline Extractor")
     p.add_argument("-i","--input-dir", default="input")
     p.add_argument("-o","--output-dir", default="output")
-    p.add_argument("-j","--jobs", type=int, default=1,
+    p.add_argument("-j","--jobs", type=int, default=0,
                    help="0=CPU count, >0 for that many workers")
     p.add_argument("-t","--thumbnails", action="store_true")
     p.add_argument("--thumb-size", nargs=2, type=int, default=[300,400], metavar=("W","H"))
+    p.add_argument("--no-cache", action="store_true",
+                   help=f"re-extract every PDF instead of reusing {CACHE_DIR}/ in the output dir")
     args = p.parse_args()
 
     os.makedirs(args.output_dir, exist_ok=True)
     if args.thumbnails:
         os.makedirs(os.path.join(args.output_dir, "thumbnails"), exist_ok=True)
 
-    pdfs = [os.path.join(args.input_dir,f)
-            for f in os.listdir(args.input_dir)
-            if f.lower().endswith(".pdf")]
+    # scandir yields type info with each entry, so filtering needs no extra stat calls
+    with os.scandir(args.input_dir) as it:
+        entries = [e for e in it if e.name.lower().endswith(".pdf") and e.is_file()]
+    entries.sort(key=lambda e: e.name)
+    pdfs = [e.path for e in entries]
     if not pdfs:
         print("No PDF files found in input directory.")
         return
 
-    workers = cpu_count() if args.jobs==0 else min(args.jobs, len(pdfs))
+    workers = min(cpu_count() if args.jobs==0 else args.jobs, len(pdfs))
     start = time.time()
     results = []
 
     if workers <= 1:
-        for pdf in pdfs:
-            r = process_pdf(pdf, args.output_dir, args.thumbnails, tuple(args.thumb_size))
+        for r in run_pipeline(pdfs, args.output_dir, args.thumbnails, tuple(args.thumb_size),
+                              use_cache=not args.no_cache):
             print(f"✅ {r['file']}: {r['headings']} headings")
             results.append(r)
     else:
+        # Batch several PDFs per task to amortize IPC on large directories
+        chunksize = max(1, len(pdfs) // (workers * 4))
+        worker = partial(process_pdf, output_dir=args.output_dir,
+                         generate_thumbs=args.thumbnails, thumb_size=tuple(args.thumb_size),
+                         use_cache=not args.no_cache)
         with ProcessPoolExecutor(max_workers=workers) as ex:
-            futures = [ex.submit(process_pdf, pdf, args.output_dir, args.thumbnails, tuple(args.thumb_size))
-                       for pdf in pdfs]
-            for fut in futures:
-                r = fut.result()
+            for r in ex.map(worker, pdfs, chunksize=chunksize):
                 print(f"✅ {r['file']}: {r['headings']} headings")
                 results.append(r)
 
@@ -198,8 +411,7 @@ def main():
             sum(r["headings"] for r in results) / len(results), 2
         ) if results else 0.0
     }
-    with open(os.path.join(args.output_dir, "stats.json"), "w", encoding="utf-8") as f:
-        json.dump(stats, f, ensure_ascii=False, indent=2)
+    write_json(os.path.join(args.output_dir, "stats.json"), stats)
 
     elapsed = time.time() - start
     print(f"\n🚀 Done in {elapsed:.2f}s | Processed {stats['num_docs']} PDFs | "